@@ -1,8 +1,27 @@
+import asyncio
+
 from s3.app.core.loader import app
-from s3.app.routers.chunk_upload import router as chunk_upload_router
-from s3.app.routers.file_upload import router as chunk_upload_router
+from s3.app.routers.chunk_upload import router as chunk_upload_router, abort_expired_uploads
+from s3.app.routers.file_upload import router as file_upload_router
+from s3.app.utils.s3 import s3_client
+from s3.app.utils.uploads import upload_store
 
 app.include_router(chunk_upload_router)
+app.include_router(file_upload_router)
+
+
+async def start_abort_expired_uploads() -> None:
+    app.state.abort_expired_uploads = asyncio.create_task(abort_expired_uploads())
+
+
+async def stop_abort_expired_uploads() -> None:
+    app.state.abort_expired_uploads.cancel()
+
+
+app.add_event_handler("startup", start_abort_expired_uploads)
+app.add_event_handler("shutdown", stop_abort_expired_uploads)
+app.add_event_handler("shutdown", s3_client.close)
+app.add_event_handler("shutdown", upload_store.close)
 
 if __name__ == '__main__':
     import uvicorn
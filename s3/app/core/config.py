@@ -1,11 +1,10 @@
 from pathlib import Path
+from typing import Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-DIR = Path(__file__).absolute().parent.parent.parent
-APP_DIR = Path(__file__).absolute().parent.parent
-TEMP_DIR = f"{APP_DIR}/temp"
-UPLOAD_DIR = f"{TEMP_DIR}/upload"
+APP_DIR = Path(__file__).resolve().parent.parent
+DIR = APP_DIR.parent
 
 
 class EnvBaseSettings(BaseSettings):
@@ -13,14 +12,23 @@ class EnvBaseSettings(BaseSettings):
 
 
 class S3Settings(EnvBaseSettings):
+    model_config = SettingsConfigDict(frozen=True)
+
     S3_BUCKET: str
     S3_ENDPOINT: str
     S3_ACCESS_KEY: str
     S3_SECRET_ACCESS_KEY: str
     S3_REGION: str = 'ru-1'
+    S3_MAX_CONNECTIONS: int = 64  # Connections to the endpoint, and so uploads in flight, per worker process
+
+
+class RedisSettings(EnvBaseSettings):
+    model_config = SettingsConfigDict(frozen=True)
+
+    REDIS_URL: Optional[str] = None  # Upload state is kept in process memory when not set
 
 
-class Settings(S3Settings):
+class Settings(S3Settings, RedisSettings):
     pass
 
 
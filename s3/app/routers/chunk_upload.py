@@ -1,88 +1,135 @@
-import os
-import shutil
+import asyncio
+import math
 import uuid
 
-import aiofiles
-from fastapi import APIRouter, UploadFile, Form, Request, HTTPExeption  # noqa
+from fastapi import APIRouter, UploadFile, Form, Request, HTTPException  # noqa
 from loguru import logger  # noqa
 
-from s3.app.core.config import UPLOAD_DIR, settings
+from s3.app.core.config import settings
+from s3.app.services.s3 import MAX_PARTS, MAX_PART_SIZE, MIN_PART_SIZE, S3Exception
 from s3.app.utils.s3 import s3_client
+from s3.app.utils.uploads import upload_store
 
 router = APIRouter(prefix="/upload/chunk")
 
+# CompleteMultipartUpload errors after which the multipart upload can only be aborted
+PERMANENT_COMPLETE_ERRORS = {"InvalidPart", "InvalidPartOrder", "EntityTooSmall", "NoSuchUpload"}
+
+
+async def abort_upload(upload_id: str, upload: dict) -> None:
+    """ Abort the S3 multipart upload behind a chunked upload and forget it. """
+    try:
+        await s3_client.abort_multipart(settings.S3_BUCKET, upload["s3_key"], upload["s3_upload_id"])
+    except Exception as e:
+        logger.error(f"Error aborting multipart upload {upload['s3_upload_id']}: {e}")
+    await upload_store.delete(upload_id)
+
+
+async def abort_expired_uploads(interval: int = 60 * 60) -> None:
+    """ Periodically abort the S3 multipart uploads of chunked uploads that stopped receiving chunks. """
+    while True:
+        try:
+            for upload_id, upload in await upload_store.pop_expired():
+                logger.warning(f"Aborting abandoned upload: {upload_id}")
+                await abort_upload(upload_id, upload)
+        except Exception as e:
+            logger.error(f"Error aborting abandoned uploads: {e}")
+        await asyncio.sleep(interval)
+
 
 @router.post("/init")
 async def init_upload_handler(
         filename: str = Form(...),
         file_size: int = Form(...),
+        chunk_size: int = Form(...),
 ) -> dict:
+    if file_size < 0 or not 0 < chunk_size <= MAX_PART_SIZE:
+        raise HTTPException(status_code=400, detail="Invalid file or chunk size")
+    chunk_count = max(math.ceil(file_size / chunk_size), 1)
+    if chunk_count > MAX_PARTS:
+        raise HTTPException(status_code=400, detail=f"Too many chunks, at most {MAX_PARTS} are allowed")
+    if chunk_count > 1 and chunk_size < MIN_PART_SIZE:
+        raise HTTPException(status_code=400, detail=f"Chunk size must be at least {MIN_PART_SIZE} bytes")
+
     upload_id = str(uuid.uuid4())
-    upload_dir = os.path.join(UPLOAD_DIR, upload_id)
-    os.makedirs(upload_dir, exist_ok=True)
+    s3_key = f"example/{filename}"  # Replace the example with your real path
+
+    try:
+        s3_upload_id = await s3_client.initiate_multipart(settings.S3_BUCKET, s3_key)
+    except Exception as e:
+        logger.error(f"Error initiating multipart upload: {e}")
+        raise HTTPException(status_code=500, detail="Error initiating multipart upload")
+
+    await upload_store.create(upload_id, s3_key, s3_upload_id, chunk_count)
 
     return {"upload_id": upload_id}
 
 
 @router.post("/")
 async def upload_chunk_handler(
-        upload_id: str = Form(...),
-        chunk_index: int = Form(...),
-        file: UploadFile = Form(...),
+        upload_id: str,
+        chunk_index: int,
+        request: Request,
 ) -> dict:
+    # The chunk is the raw request body, streamed to S3 as it arrives instead of being spooled to disk by UploadFile
     try:
-        upload_dir = os.path.join(UPLOAD_DIR, upload_id)
-        if not os.path.exists(upload_dir):
+        content_length = request.headers.get("content-length")
+        if content_length is None or not content_length.isdigit():
+            raise HTTPException(status_code=411, detail="Content-Length is required")
+        content_length = int(content_length)
+        if content_length > MAX_PART_SIZE:
+            raise HTTPException(status_code=413, detail=f"Chunk is larger than {MAX_PART_SIZE} bytes")
+        upload = await upload_store.get(upload_id)
+        if upload is None:
             logger.warning(f"Invalid upload id: {upload_id}")
-            return HTTPExeption(status_code=403, detail="Invalid upload id")
-        chunk_filename = os.path.join(upload_dir, f"chunk_{chunk_index}")
-        async with aiofiles.open(chunk_filename, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)
-                if not chunk:
-                    break
-                await f.write(chunk)
+            raise HTTPException(status_code=403, detail="Invalid upload id")
+        if not 0 <= chunk_index < upload["chunk_count"]:
+            logger.warning(f"Invalid chunk index {chunk_index} for upload id: {upload_id}")
+            raise HTTPException(status_code=403, detail="Invalid chunk index")
+        part_number = chunk_index + 1
+        etag = await s3_client.upload_part(
+            settings.S3_BUCKET,
+            upload["s3_key"],
+            upload["s3_upload_id"],
+            part_number,
+            request.stream(),
+            content_length,
+        )
+        if not await upload_store.add_part(upload_id, part_number, etag):
+            logger.warning(f"Upload finished while a chunk was being uploaded: {upload_id}")
+            raise HTTPException(status_code=403, detail="Invalid upload id")
         return {"detail": "chunk uploaded"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading chunk: {e}")
-        return HTTPExeption(status_code=403, detail="Error uploading chunk")
+        raise HTTPException(status_code=403, detail="Error uploading chunk")
 
 
 @router.post("/complete")
 async def complete_upload_handler(
         upload_id: str = Form(...),
-        filename: str = Form(...),
 ):
-    upload_dir = os.path.join(UPLOAD_DIR, upload_id)
-    if not os.path.exists(upload_dir):
+    upload = await upload_store.get(upload_id)
+    if upload is None:
         logger.error(f"Invalid upload id: {upload_id}")
-        return HTTPExeption(status_code=403, content="Invalid upload id")
-
-    chunk_files = sorted(
-        [f for f in os.listdir(upload_dir) if f.startswith("chunk_")],
-        key=lambda x: int(x.split("_")[1])
-    )
-
-    merged_filepath = os.path.join(UPLOAD_DIR, f"{upload_id}_{filename}")
-    with open(merged_filepath, "wb") as merged_file:
-        for chunk_file in chunk_files:
-            chunk_path = os.path.join(upload_dir, chunk_file)
-            with open(chunk_path, "rb") as cf:
-                while True:
-                    data = cf.read(1024 * 1024)
-                    if not data:
-                        break
-                    merged_file.write(data)
-
-    shutil.rmtree(upload_dir)
-    s3_key = f"example/{filename}"  # Replace the example with your real path
+        raise HTTPException(status_code=403, detail="Invalid upload id")
+    parts = await upload_store.get_parts(upload_id)
+    if len(parts) != upload["chunk_count"]:
+        logger.error(f"Missing chunks for upload id: {upload_id}")
+        raise HTTPException(status_code=400, detail="Missing chunks")
 
     try:
-        await s3_client.upload_file_multipart(settings.S3_BUCKET, s3_key, merged_filepath)
+        await s3_client.complete_multipart(
+            settings.S3_BUCKET, upload["s3_key"], upload["s3_upload_id"], list(parts.items())
+        )
     except Exception as e:
-        logger.error(f"Error uploading merged file to S3: {e}")
-        return HTTPExeption(status_code=500, detail="Error uploading merged file to S3")
+        logger.error(f"Error uploading file to S3: {e}")
+        # S3 rejected the parts themselves, so a retry cannot succeed; other errors (timeouts, clock skew) are kept
+        if isinstance(e, S3Exception) and e.code in PERMANENT_COMPLETE_ERRORS:
+            await abort_upload(upload_id, upload)
+        raise HTTPException(status_code=500, detail="Error uploading file to S3")
 
-    os.remove(merged_filepath)
+    await upload_store.delete(upload_id)
 
     return {"detail": "Successful Upload Video"}
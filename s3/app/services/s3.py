@@ -1,4 +1,5 @@
-from typing import Any
+import asyncio
+from typing import Any, AsyncIterable, AsyncIterator, Optional, Union
 
 import aiohttp
 import aiofiles
@@ -8,6 +9,81 @@ import datetime
 import json
 import base64
 import os
+import time
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+from yarl import URL
+
+
+def _derive_signing_key(secret_key: str, date_stamp: str, region: str, service: str) -> bytes:
+    """ Derive the AWS Signature Version 4 signing key. """
+    k_date = hmac.digest(("AWS4" + secret_key).encode("utf-8"), date_stamp.encode("utf-8"), "sha256")
+    k_region = hmac.digest(k_date, region.encode("utf-8"), "sha256")
+    k_service = hmac.digest(k_region, service.encode("utf-8"), "sha256")
+    k_signing = hmac.digest(k_service, b"aws4_request", "sha256")
+    return k_signing
+
+
+# Keyed by a digest of the credentials rather than the secret itself; the inputs only change once per day
+_signing_key_cache: dict[tuple[str, str, str, str], bytes] = {}
+
+
+def _file_sha256(file_path: str) -> str:
+    """ Hash a file in fixed-size blocks without loading it into memory. """
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+async def _read_file(file_path: str) -> AsyncIterator[bytes]:
+    """ Yield the file in 1 MiB blocks. """
+    async with aiofiles.open(file_path, "rb") as f:
+        while True:
+            chunk = await f.read(1024 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _object_path(key: str) -> str:
+    """ URI-encode an object key for the canonical URI and the request path, keeping the "/" separators. """
+    return quote(key, safe="/-_.~")
+
+
+def _find_xml_text(document: str, tag: str) -> Optional[str]:
+    """ Return the text of the first element with the given tag in an S3 XML response, ignoring namespaces. """
+    for element in ElementTree.fromstring(document).iter():
+        if element.tag.rsplit("}", 1)[-1] == tag:
+            return element.text
+    return None
+
+
+_amz_date_cache: dict[int, str] = {}
+
+
+def _amz_dates() -> tuple[str, str]:
+    """ Return the current (amz_date, date_stamp) pair, formatting the timestamp at most once per second. """
+    ts = int(time.time())
+    amz_date = _amz_date_cache.get(ts)
+    if amz_date is None:
+        if len(_amz_date_cache) >= 4:
+            _amz_date_cache.clear()
+        amz_date = _amz_date_cache[ts] = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(ts))
+    return amz_date, amz_date[:8]
+
+
+_EMPTY_PAYLOAD_HASH = hashlib.sha256(b"").hexdigest()
+_UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+_ALGORITHM = "AWS4-HMAC-SHA256"
+_ALGORITHM_BYTES = _ALGORITHM.encode("utf-8")
+_SIGNED_HEADERS = "host;x-amz-content-sha256;x-amz-date"
+_SIGNED_HEADERS_BYTES = _SIGNED_HEADERS.encode("utf-8")
+_MAX_POST_OBJECT_SIZE = 5 * 1024 * 1024 * 1024  # S3 limit for a single POST/PUT upload
+
+# S3 multipart upload limits: every part except the last must be at least MIN_PART_SIZE
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
 
 
 class S3Exception(Exception):
@@ -20,58 +96,101 @@ class S3Exception(Exception):
     def __str__(self) -> str:
         return f"S3 Error with status code {self.status_code}: {self.message}"
 
+    @property
+    def code(self) -> Optional[str]:
+        """ The S3 error code (e.g. "NoSuchUpload") from the XML error body, if there is one. """
+        try:
+            return _find_xml_text(self.message, "Code")
+        except (ElementTree.ParseError, TypeError):
+            return None
+
 
 class S3Client:
     """ S3 client used instead of boto3 to avoid errors with signing file bytes. """
 
-    def __init__(self, access_key: str, secret_key: str, endpoint: str, region: str = "us-east-1"):
-        """ Initialize the S3Client with AWS credentials, endpoint, and region. """
+    def __init__(
+            self,
+            access_key: str,
+            secret_key: str,
+            endpoint: str,
+            region: str = "us-east-1",
+            max_connections: int = 64,
+    ):
+        """ Initialize the S3Client with AWS credentials, endpoint, region and the size of the connection pool to the endpoint. """
         self.access_key = access_key
         self.secret_key = secret_key
         self.endpoint = endpoint
         self.region = region
+        self._credentials_digest = hashlib.sha256(f"{access_key}\0{secret_key}".encode("utf-8")).hexdigest()
+        # Per-client fragments of the signed request, so sign_request only fills in the request-specific parts
+        self._host_suffix = f".{endpoint}".encode("utf-8")
+        self._cred_scope_suffix = f"/{region}/s3/aws4_request".encode("utf-8")
+        self._authorization_prefix = f"{_ALGORITHM} Credential={access_key}/"
+        self._authorization_suffix = f"/{region}/s3/aws4_request, SignedHeaders={_SIGNED_HEADERS}, Signature="
+        # Requests beyond the pool size wait for a free connection, which is the only cap on concurrent uploads
+        self._max_connections = max_connections
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """ Return the shared HTTP session, creating it on first use so connections to the endpoint are kept alive. """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_connections, ttl_dns_cache=300, keepalive_timeout=60)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """ Close the shared HTTP session. """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     @staticmethod
     def get_signature_key(key: str, date_stamp: str, region: str, service: str) -> bytes:
         """ Generate the AWS Signature Version 4 signing key using the secret key, date stamp, region, and service. """
-        k_date = hmac.new(("AWS4" + key).encode("utf-8"), date_stamp.encode("utf-8"), hashlib.sha256).digest()
-        k_region = hmac.new(k_date, region.encode("utf-8"), hashlib.sha256).digest()
-        k_service = hmac.new(k_region, service.encode("utf-8"), hashlib.sha256).digest()
-        k_signing = hmac.new(k_service, b"aws4_request", hashlib.sha256).digest()
-        return k_signing
-
-    def sign_request(self, method: str, bucket: str, key: str, headers: dict, payload_hash: str) -> dict:
-        """ Sign the HTTP request for S3 using AWS Signature Version 4 by constructing the canonical request, creating the string to sign, and appending the required authorization headers. """
-        service = "s3"
-        algorithm = "AWS4-HMAC-SHA256"
-        now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
-        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
-        date_stamp = now.strftime("%Y%m%d")
+        return _derive_signing_key(key, date_stamp, region, service)
 
-        canonical_uri = f"/{key}"
-        canonical_headers = (
-            f"host:{bucket}.{self.endpoint}\n"
-            f"x-amz-content-sha256:{payload_hash}\n"
-            f"x-amz-date:{amz_date}\n"
-        )
-        signed_headers = "host;x-amz-content-sha256;x-amz-date"
-        canonical_request = f"{method}\n{canonical_uri}\n\n{canonical_headers}\n{signed_headers}\n{payload_hash}"
+    def _signing_key(self, date_stamp: str, service: str = "s3") -> bytes:
+        """ Return the signing key of this client for the date stamp, deriving it at most once per day. """
+        cache_key = (self._credentials_digest, date_stamp, self.region, service)
+        signing_key = _signing_key_cache.get(cache_key)
+        if signing_key is None:
+            if len(_signing_key_cache) >= 8:
+                _signing_key_cache.clear()
+            signing_key = _signing_key_cache[cache_key] = self.get_signature_key(
+                self.secret_key, date_stamp, self.region, service
+            )
+        return signing_key
 
-        credential_scope = f"{date_stamp}/{self.region}/s3/aws4_request"
-        string_to_sign = (
-            f"{algorithm}\n"
-            f"{amz_date}\n"
-            f"{credential_scope}\n"
-            f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
-        )
+    def _url(self, bucket: str, path: str, query: str = "") -> URL:
+        """ Build the request URL from an already URI-encoded path and query, so aiohttp sends exactly what was signed. """
+        url = f"https://{bucket}.{self.endpoint}/{path}"
+        return URL(f"{url}?{query}" if query else url, encoded=True)
 
-        signing_key = self.get_signature_key(self.secret_key, date_stamp, self.region, service)
-        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    def sign_request(self, method: str, bucket: str, path: str, headers: dict, payload_hash: str, query: str = "") -> dict:
+        """ Sign the HTTP request for S3 using AWS Signature Version 4 by constructing the canonical request, creating the string to sign, and appending the required authorization headers. The path is the URI-encoded object key. """
+        amz_date, date_stamp = _amz_dates()
+        amz_date_bytes = amz_date.encode("utf-8")
 
-        authorization_header = (
-            f"{algorithm} Credential={self.access_key}/{credential_scope}, "
-            f"SignedHeaders={signed_headers}, Signature={signature}"
-        )
+        payload_hash_bytes = payload_hash.encode("utf-8")
+        canonical_request = b"".join((
+            method.encode("utf-8"), b"\n/", path.encode("utf-8"), b"\n", query.encode("utf-8"),
+            b"\nhost:", bucket.encode("utf-8"), self._host_suffix,
+            b"\nx-amz-content-sha256:", payload_hash_bytes,
+            b"\nx-amz-date:", amz_date_bytes,
+            b"\n\n", _SIGNED_HEADERS_BYTES, b"\n", payload_hash_bytes,
+        ))
+
+        string_to_sign = b"".join((
+            _ALGORITHM_BYTES, b"\n", amz_date_bytes, b"\n",
+            date_stamp.encode("utf-8"), self._cred_scope_suffix, b"\n",
+            hashlib.sha256(canonical_request).hexdigest().encode("utf-8"),
+        ))
+
+        signing_key = self._signing_key(date_stamp)
+        signature = hmac.digest(signing_key, string_to_sign, "sha256").hex()
+
+        authorization_header = f"{self._authorization_prefix}{date_stamp}{self._authorization_suffix}{signature}"
 
         headers["Authorization"] = authorization_header
         headers["x-amz-date"] = amz_date
@@ -79,23 +198,52 @@ class S3Client:
 
         return headers
 
-    async def upload_file(self, bucket: str, key: str, file_path: str = None, file_bytes: bytes = None) -> None:
-        """ Asynchronously upload a file to the specified S3 bucket using the HTTP PUT method. """
+    async def upload_file(
+            self,
+            bucket: str,
+            key: str,
+            file_path: str = None,
+            file_bytes: bytes = None,
+            unsigned_payload: bool = True,
+    ) -> None:
+        """ Asynchronously upload a file to the specified S3 bucket using the HTTP PUT method. With unsigned_payload the body is not hashed up front and is sent as UNSIGNED-PAYLOAD, which S3 accepts over HTTPS. """
+        if unsigned_payload:
+            payload_hash = _UNSIGNED_PAYLOAD
+        elif file_path:
+            payload_hash = await asyncio.to_thread(_file_sha256, file_path)
+        else:
+            payload_hash = hashlib.sha256(file_bytes).hexdigest()
+
         if file_path:
-            async with aiofiles.open(file_path, "rb") as f:
-                data = await f.read()
+            # Streamed from disk while sending
+            data = _read_file(file_path)
+            content_length = os.path.getsize(file_path)
         else:
             data = file_bytes
+            content_length = len(file_bytes)
 
-        payload_hash = hashlib.sha256(data).hexdigest()
-        headers = self.sign_request("PUT", bucket, key, {}, payload_hash)
-        url = f"https://{bucket}.{self.endpoint}/{key}"
+        await self.upload_file_streaming(bucket, key, data, content_length, payload_hash)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.put(url, data=data, headers=headers) as response:
-                if response.status not in (200, 204):
-                    text = await response.text()
-                    raise S3Exception(status_code=response.status, message=text)
+    async def upload_file_streaming(
+            self,
+            bucket: str,
+            key: str,
+            stream: Union[AsyncIterable[bytes], bytes],
+            content_length: int,
+            payload_hash: str = _UNSIGNED_PAYLOAD,
+    ) -> None:
+        """ Asynchronously upload a stream of bytes to the specified S3 bucket using the HTTP PUT method. By default the body is sent as UNSIGNED-PAYLOAD while it is being read, so memory use does not depend on the file size. """
+        path = _object_path(key)
+        headers = self.sign_request("PUT", bucket, path, {}, payload_hash)
+        # S3 rejects chunked PUT bodies, so the size of the stream is sent explicitly
+        headers["Content-Length"] = str(content_length)
+        url = self._url(bucket, path)
+
+        session = await self._get_session()
+        async with session.put(url, data=stream, headers=headers) as response:
+            if response.status not in (200, 204):
+                text = await response.text()
+                raise S3Exception(status_code=response.status, message=text)
 
     async def upload_file_multipart(self, bucket: str, key: str, file_path: str) -> None:
         """ Asynchronously upload a file to the specified S3 bucket using the HTTP POST method with multipart/form-data. This method utilizes an S3 POST policy with AWS Signature Version 4. """
@@ -116,36 +264,112 @@ class S3Client:
                 {"key": key},
                 {"x-amz-algorithm": algorithm},
                 {"x-amz-credential": credential},
-                {"x-amz-date": amz_date}
+                {"x-amz-date": amz_date},
+                ["content-length-range", 0, _MAX_POST_OBJECT_SIZE]
             ]
         }
 
-        policy_json = json.dumps(policy_document)
-        policy_base64 = base64.b64encode(policy_json.encode("utf-8")).decode("utf-8")
-
-        signing_key = self.get_signature_key(self.secret_key, date_stamp, self.region, service)
-        signature = hmac.new(signing_key, policy_base64.encode("utf-8"), hashlib.sha256).hexdigest()
-
-        async with aiofiles.open(file_path, "rb") as f:
-            file_data = await f.read()
-
-        form = aiohttp.FormData()
-        form.add_field("key", key)
-        form.add_field("x-amz-algorithm", algorithm)
-        form.add_field("x-amz-credential", credential)
-        form.add_field("x-amz-date", amz_date)
-        form.add_field("policy", policy_base64)
-        form.add_field("x-amz-signature", signature)
-        form.add_field(
-            "file",
-            file_data,
-            filename=os.path.basename(file_path),
-            content_type="application/octet-stream"
-        )
+        policy_base64 = base64.b64encode(json.dumps(policy_document, separators=(",", ":")).encode("utf-8"))
+
+        signing_key = self._signing_key(date_stamp, service)
+        signature = hmac.digest(signing_key, policy_base64, "sha256").hex()
 
         url = f"https://{bucket}.{self.endpoint}/"
-        async with aiohttp.ClientSession() as session:
+        session = await self._get_session()
+        # The file object is streamed by aiohttp in an executor and its size is known up front,
+        # so the body is sent with a Content-Length (S3 rejects chunked POST uploads) without loading it into memory
+        with open(file_path, "rb") as f:
+            form = aiohttp.FormData()
+            form.add_field("key", key)
+            form.add_field("x-amz-algorithm", algorithm)
+            form.add_field("x-amz-credential", credential)
+            form.add_field("x-amz-date", amz_date)
+            form.add_field("policy", policy_base64.decode("ascii"))
+            form.add_field("x-amz-signature", signature)
+            form.add_field(
+                "file",
+                f,
+                filename=os.path.basename(file_path),
+                content_type="application/octet-stream"
+            )
+
             async with session.post(url, data=form) as response:
                 if response.status not in (200, 204):
                     text = await response.text()
                     raise S3Exception(status_code=response.status, message=text)
+
+    async def initiate_multipart(self, bucket: str, key: str) -> str:
+        """ Start an S3 multipart upload (CreateMultipartUpload) and return its UploadId. """
+        query = "uploads="
+        path = _object_path(key)
+        headers = self.sign_request("POST", bucket, path, {}, _EMPTY_PAYLOAD_HASH, query)
+        url = self._url(bucket, path, query)
+
+        session = await self._get_session()
+        async with session.post(url, headers=headers) as response:
+            text = await response.text()
+            if response.status != 200:
+                raise S3Exception(status_code=response.status, message=text)
+
+        upload_id = _find_xml_text(text, "UploadId")
+        if not upload_id:
+            raise S3Exception(status_code=response.status, message=text)
+        return upload_id
+
+    async def upload_part(
+            self,
+            bucket: str,
+            key: str,
+            upload_id: str,
+            part_number: int,
+            data_iter: AsyncIterable[bytes],
+            content_length: int,
+    ) -> str:
+        """ Stream a single part of a multipart upload (UploadPart) as UNSIGNED-PAYLOAD and return its ETag. """
+        query = f"partNumber={part_number}&uploadId={quote(upload_id, safe='-_.~')}"
+        path = _object_path(key)
+        url = self._url(bucket, path, query)
+
+        headers = self.sign_request("PUT", bucket, path, {}, _UNSIGNED_PAYLOAD, query)
+        # S3 does not accept chunked transfer encoding here, so the size of the streamed body is sent explicitly
+        headers["Content-Length"] = str(content_length)
+        session = await self._get_session()
+        async with session.put(url, data=data_iter, headers=headers) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise S3Exception(status_code=response.status, message=text)
+            return response.headers["ETag"]
+
+    async def complete_multipart(self, bucket: str, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        """ Finish a multipart upload (CompleteMultipartUpload) from a list of (part number, ETag) pairs. """
+        query = f"uploadId={quote(upload_id, safe='-_.~')}"
+        body = "".join(
+            f"<Part><PartNumber>{part_number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for part_number, etag in sorted(parts)
+        )
+        data = f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode("utf-8")
+        payload_hash = hashlib.sha256(data).hexdigest()
+        path = _object_path(key)
+        headers = self.sign_request("POST", bucket, path, {}, payload_hash, query)
+        url = self._url(bucket, path, query)
+
+        session = await self._get_session()
+        async with session.post(url, data=data, headers=headers) as response:
+            text = await response.text()
+            # S3 may answer 200 and still report the failure in the response body
+            if response.status != 200 or _find_xml_text(text, "Code") is not None:
+                raise S3Exception(status_code=response.status, message=text)
+
+    async def abort_multipart(self, bucket: str, key: str, upload_id: str) -> None:
+        """ Abort a multipart upload (AbortMultipartUpload) so S3 discards its uploaded parts. """
+        query = f"uploadId={quote(upload_id, safe='-_.~')}"
+        path = _object_path(key)
+        headers = self.sign_request("DELETE", bucket, path, {}, _EMPTY_PAYLOAD_HASH, query)
+        url = self._url(bucket, path, query)
+
+        session = await self._get_session()
+        async with session.delete(url, headers=headers) as response:
+            # 404 (NoSuchUpload) means the upload is already gone, which is what aborting is for
+            if response.status not in (200, 204, 404):
+                text = await response.text()
+                raise S3Exception(status_code=response.status, message=text)
@@ -0,0 +1,125 @@
+import time
+from typing import Optional
+
+from redis.asyncio import Redis
+
+_DEADLINES_KEY = "uploads:deadlines"
+
+# Records a part only while the upload exists, so a completed or aborted upload cannot leave orphaned keys behind
+_ADD_PART_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+redis.call("ZADD", KEYS[3], ARGV[4], ARGV[5])
+return 1
+"""
+
+
+class UploadStore:
+    """ State of chunked uploads: S3 multipart ids and the ETags of the uploaded parts. Kept in Redis when a URL is given, so every worker sees the same uploads, otherwise in process memory.
+
+    An upload that receives no chunk for ttl seconds is reported by pop_expired so its S3 multipart upload can be aborted.
+    In-memory state is lost on restart, so the bucket should also have a lifecycle rule that aborts incomplete multipart uploads. """
+
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = 24 * 60 * 60):
+        """ Initialize the store with an optional Redis URL and the lifetime of an inactive upload in seconds. """
+        self.ttl = ttl
+        self._redis: Optional[Redis] = Redis.from_url(redis_url, decode_responses=True) if redis_url else None
+        self._uploads: dict[str, dict] = {}
+        self._parts: dict[str, dict[int, str]] = {}
+        self._deadlines: dict[str, float] = {}
+        self._add_part_script = self._redis.register_script(_ADD_PART_SCRIPT) if self._redis is not None else None
+
+    @property
+    def _key_ttl(self) -> int:
+        """ Redis keys outlive the deadline so an expired upload can still be read and aborted. """
+        return self.ttl * 2
+
+    async def create(self, upload_id: str, s3_key: str, s3_upload_id: str, chunk_count: int) -> None:
+        """ Register a new upload. """
+        upload = {"s3_key": s3_key, "s3_upload_id": s3_upload_id, "chunk_count": chunk_count}
+        deadline = time.time() + self.ttl
+        if self._redis is None:
+            self._uploads[upload_id] = upload
+            self._parts[upload_id] = {}
+            self._deadlines[upload_id] = deadline
+            return
+
+        async with self._redis.pipeline() as pipe:
+            pipe.hset(f"upload:{upload_id}", mapping=upload)
+            pipe.expire(f"upload:{upload_id}", self._key_ttl)
+            pipe.zadd(_DEADLINES_KEY, {upload_id: deadline})
+            await pipe.execute()
+
+    async def get(self, upload_id: str) -> Optional[dict]:
+        """ Return the upload registered under upload_id, or None if there is no such upload. """
+        if self._redis is None:
+            return self._uploads.get(upload_id)
+
+        upload = await self._redis.hgetall(f"upload:{upload_id}")
+        if not upload:
+            return None
+        upload["chunk_count"] = int(upload["chunk_count"])
+        return upload
+
+    async def add_part(self, upload_id: str, part_number: int, etag: str) -> bool:
+        """ Record the ETag of an uploaded part and extend the lifetime of the upload. Return False if the upload no longer exists. """
+        deadline = time.time() + self.ttl
+        if self._redis is None:
+            if upload_id not in self._uploads:
+                return False
+            self._parts[upload_id][part_number] = etag
+            self._deadlines[upload_id] = deadline
+            return True
+
+        keys = [f"upload:{upload_id}", f"upload:{upload_id}:parts", _DEADLINES_KEY]
+        args = [part_number, etag, self._key_ttl, deadline, upload_id]
+        return bool(await self._add_part_script(keys=keys, args=args))
+
+    async def get_parts(self, upload_id: str) -> dict[int, str]:
+        """ Return the ETags of the uploaded parts keyed by part number. """
+        if self._redis is None:
+            return dict(self._parts.get(upload_id, {}))
+
+        parts = await self._redis.hgetall(f"upload:{upload_id}:parts")
+        return {int(part_number): etag for part_number, etag in parts.items()}
+
+    async def pop_expired(self) -> list[tuple[str, dict]]:
+        """ Return the uploads whose deadline has passed and stop tracking their deadlines. With Redis each expired upload is returned to one worker only. """
+        now = time.time()
+        if self._redis is None:
+            expired = [upload_id for upload_id, deadline in self._deadlines.items() if deadline <= now]
+            for upload_id in expired:
+                del self._deadlines[upload_id]
+            return [(upload_id, self._uploads[upload_id]) for upload_id in expired]
+
+        uploads = []
+        for upload_id in await self._redis.zrangebyscore(_DEADLINES_KEY, "-inf", now):
+            # Only the worker whose ZREM removed the entry handles the upload
+            if not await self._redis.zrem(_DEADLINES_KEY, upload_id):
+                continue
+            upload = await self.get(upload_id)
+            if upload is not None:
+                uploads.append((upload_id, upload))
+        return uploads
+
+    async def delete(self, upload_id: str) -> None:
+        """ Forget a finished upload. """
+        if self._redis is None:
+            self._uploads.pop(upload_id, None)
+            self._parts.pop(upload_id, None)
+            self._deadlines.pop(upload_id, None)
+            return
+
+        async with self._redis.pipeline() as pipe:
+            pipe.delete(f"upload:{upload_id}", f"upload:{upload_id}:parts")
+            pipe.zrem(_DEADLINES_KEY, upload_id)
+            await pipe.execute()
+
+    async def close(self) -> None:
+        """ Close the Redis connection pool, if any. """
+        if self._redis is not None:
+            await self._redis.aclose()
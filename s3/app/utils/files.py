@@ -0,0 +1,23 @@
+import os
+from typing import AsyncIterator
+
+from fastapi import UploadFile
+
+
+def upload_size(file: UploadFile) -> int:
+    """ Return the size of the uploaded file, measuring the spooled file when the form parser did not record it. """
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(position)
+    return size
+
+
+async def read_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+    """ Yield the uploaded file in 1 MiB blocks. """
+    while True:
+        chunk = await file.read(1024 * 1024)
+        if not chunk:
+            break
+        yield chunk
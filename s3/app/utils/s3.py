@@ -5,5 +5,6 @@ s3_client = S3Client(
     access_key=settings.S3_ACCESS_KEY,
     secret_key=settings.S3_SECRET_ACCESS_KEY,
     endpoint=settings.S3_ENDPOINT,
-    region=settings.S3_REGION
+    region=settings.S3_REGION,
+    max_connections=settings.S3_MAX_CONNECTIONS,
 )
\ No newline at end of file
@@ -0,0 +1,4 @@
+from s3.app.core.config import settings
+from s3.app.services.uploads import UploadStore
+
+upload_store = UploadStore(redis_url=settings.REDIS_URL)